@@ -0,0 +1,298 @@
+#! /usr/bin/env python
+#
+#  Copyright 2019 Henning Follmann <hfollmann@itcfollmann.com>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Headless MCA8000D acquisition, streams snapshots to stdout or a file"""
+
+
+import argparse
+import errno
+import json
+import os
+import struct
+import sys
+import time
+
+import mca8000d
+
+
+# binary record (little endian):
+#   magic 'MCAS'
+#   double  timestamp (sec since epoch)
+#   double  latency of the request (sec)
+#   uint32  RealTime, LiveTime, AccumulationTime (msec)
+#   uint32  FastCount, SlowCount, GP_COUNTER
+#   uint8   flags (see statusFlags, bit 0 is the first entry)
+#   uint32  number of channels
+#   uint32  channel data ...
+recordMagic = b'MCAS'
+recordHeader = struct.Struct('<4sdd6IBI')
+
+statusFlags = ['MCA_EN', 'PresetRtDone', 'PresetLtDone', 'PRECNT_REACHED',
+               'MCS_DONE', 'DP5_CONFIGURED']
+
+
+def statusDict(status):
+    """status as dictionary (all fields)"""
+    return dict(vars(status))
+
+
+def packRecord(timestamp, latency, spectrum, status):
+    """pack one snapshot into a binary record"""
+    flags = 0
+    for bit, name in enumerate(statusFlags):
+        if getattr(status, name):
+            flags |= 1 << bit
+    header = recordHeader.pack(recordMagic, timestamp, latency,
+                               status.RealTime, status.LiveTime,
+                               status.AccumulationTime, status.FastCount,
+                               status.SlowCount, status.GP_COUNTER,
+                               flags, len(spectrum))
+    return header + struct.pack('<%dI' % len(spectrum), *spectrum)
+
+
+def formatRecord(timestamp, latency, spectrum, status):
+    """format one snapshot as a json line"""
+    rec = {'time': timestamp,
+           'latency': latency,
+           'status': statusDict(status),
+           'spectrum': spectrum}
+    return (json.dumps(rec, separators=(',', ':')) + '\n').encode('ascii')
+
+
+def presetsDone(status):
+    """True if any preset (real time, live time, counts) is reached"""
+    return status.PresetRtDone or status.PresetLtDone or status.PRECNT_REACHED
+
+
+def presetCmd(args):
+    """configuration string for the presets given on the command line"""
+    cmd = ''
+    if args.realtime is not None:
+        cmd += 'PRER=' + ('%.2f' % args.realtime if args.realtime > 0 else 'OFF') + ';'
+    if args.livetime is not None:
+        cmd += 'PREL=' + ('%.2f' % args.livetime if args.livetime > 0 else 'OFF') + ';'
+    if args.counts is not None:
+        cmd += 'PREC=' + (str(args.counts) if args.counts > 0 else 'OFF') + ';'
+    return cmd
+
+
+class latencyStats:
+    """running latency statistics
+       percentiles come from a histogram with binWidth sec bins, so the
+       memory needed does not grow with the length of the run"""
+    binWidth = 0.0001
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+        self.bins = {}
+
+    def add(self, latency):
+        self.count += 1
+        self.total += latency
+        if self.min is None or latency < self.min:
+            self.min = latency
+        if self.max is None or latency > self.max:
+            self.max = latency
+        b = int(latency / self.binWidth)
+        self.bins[b] = self.bins.get(b, 0) + 1
+
+    def mean(self):
+        return self.total / self.count
+
+    def percentile(self, p):
+        """upper edge of the bin holding the p (0..1) percentile"""
+        rank = p * self.count
+        seen = 0
+        for b in sorted(self.bins):
+            seen += self.bins[b]
+            if seen >= rank:
+                break
+        return min((b + 1) * self.binWidth, self.max)
+
+
+def printSummary(out, elapsed, stats, reason):
+    """write poll rate and latency statistics"""
+    out.write('================ MCA8000D acquisition ==============\n')
+    out.write('Stopped by      : ' + reason + '\n')
+    out.write('Snapshots       : ' + str(stats.count) + '\n')
+    out.write('Elapsed         : %.3f sec\n' % elapsed)
+    if stats.count > 0 and elapsed > 0:
+        out.write('Poll rate       : %.1f Hz\n' % (stats.count / elapsed))
+    if stats.count > 0:
+        out.write('Latency min     : %.2f msec\n' % (stats.min * 1000))
+        out.write('Latency mean    : %.2f msec\n' % (stats.mean() * 1000))
+        out.write('Latency p95     : %.2f msec\n' % (stats.percentile(0.95) * 1000))
+        out.write('Latency max     : %.2f msec\n' % (stats.max * 1000))
+    out.write('====================================================\n')
+
+
+# why the acquisition stopped and the exit status of main()
+exitCodes = {'preset': 0,
+             'stopped': 0,
+             'snapshot limit': 0,
+             'interrupted': 0,
+             'error': 1,
+             'device lost': 2,
+             'broken pipe': 3}
+
+
+def endReason(err):
+    """reason for an error which ends the acquisition normally,
+       None if it is a real error"""
+    if isinstance(err, mca8000d.DeviceNotFound):
+        # not found again after an unplug
+        return 'device lost'
+    if isinstance(err, IOError):
+        # usb.core.USBError is an IOError too
+        if err.errno == errno.EPIPE:
+            return 'broken pipe'
+        if mca8000d.isDisconnect(err):
+            return 'device lost'
+    return None
+
+
+def parseArgs(argv):
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     epilog='exit status: 0 done, 1 error, '
+                                     '2 device lost, 3 broken pipe')
+    parser.add_argument('-c', '--config', help='hardware configuration file')
+    parser.add_argument('-r', '--realtime', type=float, help='preset real time (sec), 0 is off')
+    parser.add_argument('-l', '--livetime', type=float, help='preset live time (sec), 0 is off')
+    parser.add_argument('-n', '--counts', type=int, help='preset counts, 0 is off')
+    parser.add_argument('-i', '--interval', type=float, default=1.0,
+                        help='poll interval (sec), 0 polls as fast as the link allows')
+    parser.add_argument('-s', '--snapshots', type=int, default=0,
+                        help='stop after this many snapshots, 0 is unlimited')
+    parser.add_argument('-f', '--format', choices=['ndjson', 'binary'], default='ndjson',
+                        help='output format')
+    parser.add_argument('-o', '--output', default='-', help='output file, - is stdout')
+    parser.add_argument('--no-clear', dest='clear', action='store_false',
+                        help='do not clear the spectrum before starting')
+    parser.add_argument('--keep-running', dest='stop', action='store_false',
+                        help='do not stop the acquisition at exit')
+    parser.add_argument('--retries', type=int, default=5,
+                        help='attach retries at start and after an unplug, '
+                        'the wait doubles from 50 msec, 0 tries once')
+    return parser.parse_args(argv)
+
+
+def acquire(dev, out, args, stats):
+    """poll dev and write snapshots to out until a preset is reached,
+       the snapshot limit is hit, the user interrupts, the reader of out
+       goes away (broken pipe) or the device is lost
+       every delivered snapshot is added to stats
+       returns why it stopped (see exitCodes)"""
+    if args.format == 'binary':
+        encode = packRecord
+    else:
+        encode = formatRecord
+    nextPoll = time.time()
+    try:
+        while True:
+            t0 = time.time()
+            spectrum, status = dev.spectrum(True, False)
+            t1 = time.time()
+            out.write(encode(t1, t1 - t0, spectrum, status))
+            out.flush()
+            stats.add(t1 - t0)
+            if presetsDone(status):
+                return 'preset'
+            if not status.MCA_EN:
+                return 'stopped'
+            if args.snapshots > 0 and stats.count >= args.snapshots:
+                return 'snapshot limit'
+            if args.interval > 0:
+                nextPoll += args.interval
+                wait = nextPoll - time.time()
+                if wait > 0:
+                    time.sleep(wait)
+                else:
+                    # fell behind, do not try to catch up
+                    nextPoll = time.time()
+    except KeyboardInterrupt:
+        return 'interrupted'
+    except (IOError, mca8000d.DeviceNotFound) as err:
+        reason = endReason(err)
+        if reason is None:
+            raise
+        sys.stderr.write('acquisition ended: ' + str(err) + '\n')
+        return reason
+
+
+def main(argv=None):
+    args = parseArgs(argv)
+    try:
+        dev = mca8000d.device(retries=args.retries,
+                              reconnectRetries=args.retries)
+    except (IOError, mca8000d.DeviceNotFound) as err:
+        sys.stderr.write('cannot connect: ' + str(err) + '\n')
+        return 1
+    # opened after connecting, an existing file is kept if there is no device
+    if args.output == '-':
+        out = getattr(sys.stdout, 'buffer', sys.stdout)
+    else:
+        try:
+            out = open(args.output, 'wb')
+        except IOError as err:
+            sys.stderr.write('cannot open output: ' + str(err) + '\n')
+            return 1
+    stats = latencyStats()
+    reason = 'error'
+    started = time.time()
+    try:
+        try:
+            if args.config:
+                dev.sendCmdConfig(mca8000d.createCfgString(mca8000d.readConfig(args.config)))
+            cmd = presetCmd(args)
+            if cmd:
+                dev.sendCmdConfig(cmd)
+            if args.clear:
+                dev.spectrum(True, True)
+            dev.enable_MCA_MCS()
+        except (IOError, mca8000d.DeviceNotFound) as err:
+            reason = endReason(err)
+            if reason is None:
+                raise
+            sys.stderr.write('acquisition not started: ' + str(err) + '\n')
+        else:
+            started = time.time()
+            reason = acquire(dev, out, args, stats)
+    finally:
+        if args.stop:
+            # must not hide the error which got us here
+            try:
+                dev.disable_MCA_MCS()
+            except Exception as err:
+                sys.stderr.write('could not stop acquisition: ' + str(err) + '\n')
+        try:
+            if out is getattr(sys.stdout, 'buffer', sys.stdout):
+                out.flush()
+            else:
+                out.close()
+        except IOError:
+            # broken pipe, keep the interpreter from flushing stdout again
+            if out is getattr(sys.stdout, 'buffer', sys.stdout):
+                os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        printSummary(sys.stderr, time.time() - started, stats, reason)
+    return exitCodes[reason]
+
+if __name__ == '__main__':
+
+    sys.exit(main())
@@ -18,12 +18,23 @@
 """A USB interface to AMPTEK's MCA8000d"""
    
 
-import usb.core
-import usb.util
+import errno
 import struct
 import sys
 import time
 
+# pyusb is imported on first use (see _importUsb), so the offline
+# helpers (readConfig, saveSpectrum, ...) work without it
+usb = None
+
+def _importUsb():
+    """import pyusb on demand"""
+    global usb
+    if usb is None:
+        import usb.core
+        import usb.util
+    return usb
+
 def chksum(data):
     checksum = 0;
     for b in bytearray(data):
@@ -258,40 +269,168 @@ spectrumSize ={ 1 : 255,\
                 12 : 8191}  # max channel number zero indexed
 
     
-class device:
-    """device provides all communications to a mca8000d device"""
-    def __init__(self):
-        self.dev=usb.core.find(idVendor=0x10c4, idProduct=0x842a)
-        if self.dev is None:
-            raise ValueError('Device not found')
+#############################################################################
+# connection management
+# The usb handle is kept open for the lifetime of the process and shared by
+# all device instances. A handle is never reset implicitly: resetting (and
+# set_configuration on a configured device) forces a re-enumeration and
+# interrupts a running acquisition.
+VENDOR_ID = 0x10c4
+PRODUCT_ID = 0x842a
+
+# attach attempts after an unplug, a replugged device needs some
+# time to enumerate (about 1.5 sec with the default backoff)
+RECONNECT_RETRIES = 5
+
+# requests without side effects, only these are replayed after a
+# reconnect (status, spectrum without clear, config read back)
+readOnlyRequests = [(0x01, 0x01), (0x02, 0x01), (0x02, 0x03), (0x20, 0x03)]
+
+_openHandles = {}
+
+
+class DeviceNotFound(ValueError):
+    """no mca8000d device is attached"""
+    pass
+
+
+def isDisconnect(err):
+    """True if a usb error means the device was unplugged"""
+    return getattr(err, 'errno', None) in (errno.ENODEV, errno.EIO)
+
+
+def _attach():
+    """find the device and configure it only if it is not configured yet"""
+    dev = usb.core.find(idVendor=VENDOR_ID, idProduct=PRODUCT_ID)
+    if dev is None:
+        return None
+    try:
+        dev.get_active_configuration()
+    except usb.core.USBError as err:
+        if isDisconnect(err):
+            raise
+        # not configured (fresh plug in)
+        dev.set_configuration()
+    return dev
+
+
+def connect(retries=0, backoff=0.05, reuse=True):
+    """return an usb handle to the mca8000d
+       an already open handle is reused if reuse is True, otherwise
+       the device is re-attached. Attaching is retried retries times,
+       waiting backoff seconds, doubled after each attempt."""
+    _importUsb()
+    key = (VENDOR_ID, PRODUCT_ID)
+    if reuse and key in _openHandles:
+        return _openHandles[key]
+    release()
+    delay = backoff
+    for attempt in range(retries + 1):
+        try:
+            dev = _attach()
+        except usb.core.USBError as err:
+            if not isDisconnect(err):
+                raise
+            dev = None
+        if dev is not None:
+            _openHandles[key] = dev
+            return dev
+        if attempt < retries:
+            time.sleep(delay)
+            delay *= 2
+    raise DeviceNotFound('Device not found')
+
+
+def release(reset=False):
+    """release the shared usb handle
+       the device is only reset if reset is True"""
+    dev = _openHandles.pop((VENDOR_ID, PRODUCT_ID), None)
+    if dev is None:
+        return
+    try:
+        if reset:
+            dev.reset()
+        usb.util.dispose_resources(dev)
+    except usb.core.USBError as err:
+        # already gone
+        if not isDisconnect(err):
+            raise
 
-            
-        self.dev.set_configuration()
-        # cfg=self.dev.get_active_configuration()
-        # intf=cfg[(0,0)]
-        # ep_out=usb.util.find_descriptor(
-        #    intf,
-        #    # match the first OUT endpoint
-        #    custom_match = \
-        #    lambda e: \
-        #    usb.util.endpoint_direction(e.bEndpointAddress) == \
-        #    usb.util.ENDPOINT_OUT)
-        # self.eout=ep_out.bEndpointAddress
-        # ep_in=usb.util.find_descriptor(
-        #     intf,
-        #     # match the first IN endpoint
-        #     custom_match = \
-        #     lambda e: \
-        #     usb.util.endpoint_direction(e.bEndpointAddress) == \
-        #     usb.util.ENDPOINT_IN)
-        # self.ein=ep_in.bEndpointAddress
+
+class device:
+    """device provides all communications to a mca8000d device
+       all instances share the usb handle of the module (see connect()),
+       it is looked up on every transfer, so a reconnect or close by one
+       instance is seen by all others"""
+    def __init__(self, retries=0, backoff=0.05, reconnectRetries=RECONNECT_RETRIES):
+        """attach to the device, reusing an open handle
+           retries and backoff are used for connecting, reconnectRetries
+           for attaching again after an unplug, see connect()"""
+        self.retries = retries
+        self.backoff = backoff
+        self.reconnectRetries = reconnectRetries
+        self.closed = False
+        connect(self.retries, self.backoff)
         self.eout=2
         self.ein=129
         self.timeout=500
 
-    def __del__(self):
-        self.dev.reset()
-        usb.util.dispose_resources(self.dev)
+    @property
+    def dev(self):
+        """the shared usb handle, re-attached if another instance
+           released it"""
+        if self.closed:
+            raise ValueError('Device is closed')
+        return connect(self.retries, self.backoff)
+
+    def reconnect(self):
+        """drop the current handle and attach again (e.g. after a replug)"""
+        if self.closed:
+            raise ValueError('Device is closed')
+        connect(self.reconnectRetries, self.backoff, reuse=False)
+
+    def close(self, reset=False):
+        """release the usb handle (of all instances)
+           if reset is True the device is reset, unless it is acquiring"""
+        if self.closed:
+            return
+        try:
+            if reset:
+                # probe without reconnecting, a gone device is just released
+                reset = False
+                dev = _openHandles.get((VENDOR_ID, PRODUCT_ID))
+                if dev is not None:
+                    self.sendCmd(1, 1, '')
+                    reset = not status(self.recvCmd()[2]).MCA_EN
+        except usb.core.USBError:
+            pass
+        finally:
+            self.closed = True
+            release(reset)
+
+    def request(self, req_pid1, req_pid2, data):
+        """sends a cmd and receives the answer
+           if the device was unplugged in between it is reconnected and
+           the cmd is sent again, unless the device may have executed it
+           already (cmd sent, answer lost) and it is not read only.
+           In that case the usb error is raised after reconnecting."""
+        try:
+            self.sendCmd(req_pid1, req_pid2, data)
+        except usb.core.USBError as err:
+            if not isDisconnect(err):
+                raise
+            self.reconnect()
+            self.sendCmd(req_pid1, req_pid2, data)
+        try:
+            return self.recvCmd()
+        except usb.core.USBError as err:
+            if not isDisconnect(err):
+                raise
+            self.reconnect()
+            if (req_pid1, req_pid2) not in readOnlyRequests:
+                raise
+        self.sendCmd(req_pid1, req_pid2, data)
+        return self.recvCmd()
 
     def sendCmd(self, req_pid1, req_pid2, data):
         """sends raw cmd over usb"""
@@ -317,8 +456,7 @@ class device:
     def reqStatus(self):
         """get status of  mca8000d device"""
         data=''
-        self.sendCmd(1,1,data)
-        statusmsg = self.recvCmd()
+        statusmsg = self.request(1,1,data)
         return (status(statusmsg[2]))
     
     def reqHWConfig(self):
@@ -328,8 +466,7 @@ class device:
             data += confp + '=?;'
         # pid1 = 0x20
         # pid2 = 0x03
-        self.sendCmd(0x20,0x03,data)
-        cfgmsg = self.recvCmd()
+        cfgmsg = self.request(0x20,0x03,data)
         l = len(cfgmsg[2])
         fmt = str(l) + 's'
         lcfgstr = struct.unpack(fmt, cfgmsg[2])
@@ -344,8 +481,7 @@ class device:
         """sends a configuration string to device"""
         # pid1 = 0x20
         # pid2 = 0x02
-        self.sendCmd(0x20, 0x02, cmd)
-        cfgmsg = self.recvCmd()
+        cfgmsg = self.request(0x20, 0x02, cmd)
         return (cfgmsg)
 
     def setPresetTime(self, time):
@@ -369,8 +505,7 @@ class device:
         data = ''
         # pid1 = 0xF0
         # pid2 = 0x02
-        self.sendCmd(0xF0, 0x02, data)
-        res = self.recvCmd()
+        res = self.request(0xF0, 0x02, data)
         return (res)
 
     # stop MCA MCS scan
@@ -379,8 +514,7 @@ class device:
         data = ''
         # pid1 = 0xF0
         # pid2 = 0x03
-        self.sendCmd(0xF0, 0x03, data)
-        res = self.recvCmd()
+        res = self.request(0xF0, 0x03, data)
         return (res)
 
     def spectrum(self, bStatus, bClear):
@@ -395,8 +529,7 @@ class device:
             Pid2 += 2
         if bClear:
             Pid2 += 1
-        self.sendCmd(0x02, Pid2, data)
-        res = self.recvCmd()
+        res = self.request(0x02, Pid2, data)
         maxChan = spectrumSize[res[1]]
         spectrum = []
         sta = None
@@ -448,7 +581,7 @@ def demo():
     dev.setPresetTime(0)
     config=dev.reqHWConfig()
     printConfig(config)
-    dev=None
+    dev.close()
     #done
 
 